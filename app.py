@@ -1,15 +1,24 @@
 import io
+import mimetypes
 import os
 import re
 import sqlite3
+import tempfile
+import threading
 import time
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
 from pathlib import Path
+from urllib.parse import quote
 
-from flask import Flask, flash, redirect, render_template, request, send_file, send_from_directory, url_for
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
+from flask import (
+    Flask, Response, abort, flash, g, redirect, render_template, request, send_from_directory, url_for
+)
 from flask_login import LoginManager, UserMixin, current_user, login_required, login_user, logout_user
-from werkzeug.security import check_password_hash, generate_password_hash
+from werkzeug.security import check_password_hash, safe_join
 from werkzeug.utils import secure_filename
 
 # ================== CONFIG ==================
@@ -19,20 +28,139 @@ DB_PATH = INSTANCE_DIR / "app.db"
 
 # Carpeta base donde se guardan TODOS los proyectos (cada proyecto será subcarpeta)
 UPLOADS_ROOT = BASE_DIR / "uploads"
-ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg", "webp"}
+ALLOWED_EXTENSIONS = frozenset({"png", "jpg", "jpeg", "webp"})
+
+# Se guarda en PRAGMA user_version; súbelo al añadir una migración nueva
+SCHEMA_VERSION = 4
+
+# Una conexión SQLite por hilo, reutilizada entre peticiones
+_db_local = threading.local()
+
+# argon2id con los parámetros recomendados por OWASP (m=46 MiB, t=1, p=1)
+_password_hasher = PasswordHasher(time_cost=1, memory_cost=47104, parallelism=1)
+
+# Hilos solo para hash/verificación de contraseñas: limitar a 4 acota la memoria
+# de argon2 (~46 MiB por hash en curso). No meter aquí trabajo largo como el zip
+# del backup, que dejaría /login esperando a que terminen las descargas.
+EXECUTOR = ThreadPoolExecutor(max_workers=4)
+
+# Tamaño de bloque al leer archivos para el zip del backup
+ZIP_CHUNK_SIZE = 256 * 1024
+
+
+def hash_password(password: str) -> str:
+    return EXECUTOR.submit(_password_hasher.hash, password).result()
+
+
+def verify_password(stored_hash: str, password: str) -> bool:
+    return EXECUTOR.submit(_verify_password, stored_hash, password).result()
+
+
+def _verify_password(stored_hash: str, password: str) -> bool:
+    if stored_hash.startswith("$argon2"):
+        try:
+            return _password_hasher.verify(stored_hash, password)
+        except (VerificationError, InvalidHashError):
+            return False
+    # hashes antiguos de Werkzeug (pbkdf2/scrypt)
+    return check_password_hash(stored_hash, password)
+
+
+def password_needs_rehash(stored_hash: str) -> bool:
+    if not stored_hash.startswith("$argon2"):
+        return True
+    return _password_hasher.check_needs_rehash(stored_hash)
+
+
+_SLUG_INVALID_RE = re.compile(r"[^a-z0-9_\-]+")
 
 
 def slugify(name: str) -> str:
-    name = name.strip().lower()
-    name = re.sub(r"\s+", "_", name)
-    name = re.sub(r"[^a-z0-9_\-]", "", name)
+    # split() sin argumentos ya colapsa y recorta cualquier espacio en blanco
+    name = _SLUG_INVALID_RE.sub("", "_".join(name.lower().split()))
     return name[:60] if name else "proyecto"
 
 
+class _ZipStream(io.RawIOBase):
+    """Destino no buscable para ZipFile: acumula lo escrito hasta que se drena."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def iter_files(root):
+    """Recorre root con os.scandir; DirEntry ya trae el tipo sin stat() extra."""
+    with os.scandir(root) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                yield from iter_files(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                yield entry.path
+
+
+def iter_zip(entries):
+    """Genera el zip por bloques a partir de pares (ruta, arcname).
+
+    Se lee de forma perezosa mientras se envía la respuesta, así que las rutas
+    deben ser archivos que nadie reescribe: la base de datos se pasa como
+    instantánea (ver download_backup), nunca app.db en vivo.
+
+    Las imágenes ya vienen comprimidas, así que se guardan con ZIP_STORED;
+    el resto (app.db) se comprime con ZIP_DEFLATED.
+    """
+    stream = _ZipStream()
+    with zipfile.ZipFile(stream, mode="w") as z:
+        for path, arcname in entries:
+            try:
+                src = open(path, "rb")
+            except FileNotFoundError:
+                # borrada o movida (delete/edit/proyecto eliminado) durante la descarga
+                continue
+
+            # tamaño y fecha del mismo archivo abierto, no de la ruta (que pudo
+            # reemplazarse entre el listado y la lectura)
+            st = os.fstat(src.fileno())
+            zinfo = zipfile.ZipInfo(arcname, time.localtime(st.st_mtime)[:6])
+            zinfo.file_size = st.st_size
+            zinfo.external_attr = (st.st_mode & 0xFFFF) << 16
+            ext = os.path.splitext(path)[1].lower().lstrip(".")
+            zinfo.compress_type = zipfile.ZIP_STORED if ext in ALLOWED_EXTENSIONS else zipfile.ZIP_DEFLATED
+
+            with src, z.open(zinfo, mode="w") as dst:
+                while True:
+                    chunk = src.read(ZIP_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+                    data = stream.drain()
+                    if data:
+                        yield data
+    yield stream.drain()
+
+
 def create_app():
     app = Flask(__name__)
     app.secret_key = os.environ.get("SECRET_KEY", "dev_secret_change_me")
 
+    # Entrega de imágenes por el servidor web (sendfile del kernel):
+    #   Apache + mod_xsendfile -> USE_X_SENDFILE=1
+    #   nginx -> UPLOADS_ACCEL_PREFIX=/_uploads (location "internal;" con alias a uploads/)
+    # Sin ninguna de las dos, Flask sirve el archivo (servidor de desarrollo).
+    app.config["USE_X_SENDFILE"] = os.environ.get("USE_X_SENDFILE") == "1"
+    uploads_accel_prefix = os.environ.get("UPLOADS_ACCEL_PREFIX", "").rstrip("/")
+
     INSTANCE_DIR.mkdir(exist_ok=True)
     UPLOADS_ROOT.mkdir(exist_ok=True)
 
@@ -43,10 +171,29 @@ def create_app():
 
     # ========== DB HELPERS ==========
     def get_db():
-        conn = sqlite3.connect(DB_PATH)
+        conn = getattr(_db_local, "conn", None)
+        if conn is not None:
+            return conn
+
+        conn = sqlite3.connect(DB_PATH, check_same_thread=False)
         conn.row_factory = sqlite3.Row
+        # journal_mode=WAL es persistente en el archivo (se fija en init_db);
+        # el resto de PRAGMAs son por conexión.
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA mmap_size=268435456")
+        conn.execute("PRAGMA cache_size=-20000")
+        _db_local.conn = conn
         return conn
 
+    @app.teardown_appcontext
+    def release_db(exc):
+        # no se cierra: solo se descarta cualquier transacción que quedó abierta
+        conn = getattr(_db_local, "conn", None)
+        if conn is not None and conn.in_transaction:
+            conn.rollback()
+
     def table_has_column(conn, table: str, column: str) -> bool:
         cols = conn.execute(f"PRAGMA table_info({table})").fetchall()
         return any(c["name"] == column for c in cols)
@@ -121,15 +268,92 @@ def create_app():
             except sqlite3.OperationalError:
                 pass
 
+    def ensure_indexes(conn):
+        # users.username y projects.slug/name ya tienen índice implícito por UNIQUE
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_photos_project_uploaded ON photos(project_id, uploaded_at DESC)"
+        )
+
+    def ensure_photos_fts(conn) -> bool:
+        # índice de texto para la búsqueda del dashboard; el tokenizer trigram
+        # permite buscar subcadenas como hacía LIKE '%q%'
+        try:
+            conn.execute("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS photos_fts USING fts5(
+                    display_name, description,
+                    content='photos', content_rowid='id', tokenize='trigram'
+                )
+            """)
+        except sqlite3.OperationalError as e:
+            # SQLite sin FTS5/trigram: el dashboard sigue usando LIKE
+            app.logger.warning(
+                "No se pudo crear photos_fts (%s); la búsqueda usará LIKE. "
+                "Se reintentará en el próximo arranque.", e
+            )
+            return False
+
+        # sentencias sueltas: executescript() haría COMMIT de la transacción de setup_db()
+        conn.execute("""
+            CREATE TRIGGER IF NOT EXISTS photos_fts_ai AFTER INSERT ON photos BEGIN
+                INSERT INTO photos_fts(rowid, display_name, description)
+                VALUES (new.id, new.display_name, new.description);
+            END
+        """)
+        conn.execute("""
+            CREATE TRIGGER IF NOT EXISTS photos_fts_ad AFTER DELETE ON photos BEGIN
+                INSERT INTO photos_fts(photos_fts, rowid, display_name, description)
+                VALUES ('delete', old.id, old.display_name, old.description);
+            END
+        """)
+        conn.execute("""
+            CREATE TRIGGER IF NOT EXISTS photos_fts_au
+            AFTER UPDATE OF display_name, description ON photos BEGIN
+                INSERT INTO photos_fts(photos_fts, rowid, display_name, description)
+                VALUES ('delete', old.id, old.display_name, old.description);
+                INSERT INTO photos_fts(rowid, display_name, description)
+                VALUES (new.id, new.display_name, new.description);
+            END
+        """)
+        conn.execute("INSERT INTO photos_fts(photos_fts) VALUES ('rebuild')")
+        return True
+
+    def ensure_projects_version(conn):
+        # contador que suben los triggers de projects; lo ven todos los workers de
+        # gunicorn, así la caché de proyectos de cada proceso sabe cuándo recargar
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS app_meta (
+                key TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            )
+        """)
+        conn.execute("INSERT OR IGNORE INTO app_meta (key, value) VALUES ('projects_version', 0)")
+
+        for event in ("INSERT", "UPDATE", "DELETE"):
+            conn.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS projects_version_{event.lower()} AFTER {event} ON projects BEGIN
+                    UPDATE app_meta SET value = value + 1 WHERE key = 'projects_version';
+                END
+            """)
+
     def init_db():
+        # se llama dentro de la transacción de setup_db(); no hace commit propio
         conn = get_db()
+
+        # esquema al día: no hace falta revisar columnas con PRAGMA table_info
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            return
+
         ensure_table_users(conn)
         ensure_table_projects(conn)
         ensure_table_photos(conn)
-        conn.commit()
-        conn.close()
-
-    init_db()
+        ensure_indexes(conn)
+        ensure_projects_version(conn)
+        # sin FTS se queda en la versión anterior para reintentarlo al arrancar
+        # (p. ej. tras actualizar SQLite)
+        fts_ok = ensure_photos_fts(conn)
+        version = SCHEMA_VERSION if fts_ok else SCHEMA_VERSION - 1
+        conn.execute(f"PRAGMA user_version = {version}")
 
     # ========== USER MODEL ==========
     class User(UserMixin):
@@ -142,11 +366,17 @@ def create_app():
     @login_manager.user_loader
     def load_user(user_id):
         conn = get_db()
-        row = conn.execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
-        conn.close()
-        return User(row) if row else None
+        row = conn.execute(
+            "SELECT id, username, password_hash, is_admin FROM users WHERE id = ?",
+            (user_id,)
+        ).fetchone()
+        user = User(row) if row else None
+        # los decoradores lo leen de g sin pasar por el LocalProxy de current_user
+        g._user = user
+        return user
 
     def ensure_admin_and_default_project():
+        # se llama dentro de la transacción de setup_db(); no hace commit propio
         conn = get_db()
 
         # admin
@@ -154,7 +384,7 @@ def create_app():
         if not existing_admin:
             conn.execute(
                 "INSERT INTO users (username, password_hash, is_admin) VALUES (?, ?, 1)",
-                ("admin", generate_password_hash("admin123")),
+                ("admin", hash_password("admin123")),
             )
 
         # default project
@@ -165,31 +395,58 @@ def create_app():
                 ("General", "general", "Proyecto por defecto", "pendiente"),
             )
 
-        conn.commit()
-
         # backfill para fotos antiguas
         general_id = conn.execute("SELECT id FROM projects WHERE slug = ?", ("general",)).fetchone()["id"]
 
-        conn.execute("UPDATE photos SET project_id = ? WHERE project_id IS NULL", (general_id,))
-        conn.execute("""
-            UPDATE photos
-            SET filepath = ('general/' || filename)
-            WHERE (filepath IS NULL OR filepath = '') AND filename IS NOT NULL
-        """)
+        pending = """
+            project_id IS NULL
+            OR ((filepath IS NULL OR filepath = '') AND filename IS NOT NULL)
+        """
+        if conn.execute(f"SELECT 1 FROM photos WHERE {pending} LIMIT 1").fetchone():
+            conn.execute(f"""
+                UPDATE photos
+                SET project_id = COALESCE(project_id, ?),
+                    filepath = CASE
+                        WHEN (filepath IS NULL OR filepath = '') AND filename IS NOT NULL
+                        THEN ('general/' || filename)
+                        ELSE filepath
+                    END
+                WHERE {pending}
+            """, (general_id,))
+
+    def setup_db():
+        conn = get_db()
+        # journal_mode no se puede cambiar dentro de una transacción
+        conn.execute("PRAGMA journal_mode=WAL")
 
-        conn.commit()
-        conn.close()
+        # los workers de gunicorn arrancan a la vez sobre el mismo archivo:
+        # BEGIN IMMEDIATE toma el lock de escritura antes de leer user_version
+        # y de sembrar admin/General, así que lo hace un solo proceso cada vez
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            init_db()
+            ensure_admin_and_default_project()
 
         (UPLOADS_ROOT / "general").mkdir(parents=True, exist_ok=True)
 
-    ensure_admin_and_default_project()
+    setup_db()
+
+    photos_fts_enabled = get_db().execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'photos_fts'"
+    ).fetchone() is not None
 
     # ========== PERMISOS ==========
+    def current_is_admin() -> bool:
+        user = g.get("_user")
+        if user is None:
+            user = current_user
+        return bool(getattr(user, "is_admin", False))
+
     def admin_required(view_func):
         @wraps(view_func)
         @login_required
         def wrapper(*args, **kwargs):
-            if not getattr(current_user, "is_admin", False):
+            if not current_is_admin():
                 flash("Acceso solo para administradores.", "error")
                 return redirect(url_for("dashboard"))
             return view_func(*args, **kwargs)
@@ -199,15 +456,45 @@ def create_app():
         @wraps(view_func)
         @login_required
         def wrapper(*args, **kwargs):
-            if not getattr(current_user, "is_admin", False):
+            if not current_is_admin():
                 flash("No tienes permisos para subir imágenes.", "error")
                 return redirect(url_for("dashboard"))
             return view_func(*args, **kwargs)
         return wrapper
 
+    # ========== CACHE DE PROYECTOS ==========
+    # guarda una tupla (versión, filas) para que leer/escribir sea atómico entre hilos;
+    # la versión es app_meta.projects_version (ver ensure_projects_version)
+    projects_cache = {}
+
+    def get_projects_cached():
+        conn = get_db()
+        version = conn.execute(
+            "SELECT value FROM app_meta WHERE key = 'projects_version'"
+        ).fetchone()["value"]
+
+        entry = projects_cache.get("entry")
+        if entry is None or entry[0] != version:
+            rows = conn.execute("SELECT id, name, slug FROM projects ORDER BY name ASC").fetchall()
+            entry = (version, rows)
+            projects_cache["entry"] = entry
+        return entry[1]
+
     # ========== UTILS ==========
     def allowed_file(filename: str) -> bool:
-        return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
+        _, dot, ext = filename.rpartition(".")
+        return bool(dot) and ext.lower() in ALLOWED_EXTENSIONS
+
+    def drop_page_cache(path) -> None:
+        # la imagen recién subida no se vuelve a leer pronto: que no desplace
+        # del page cache a la base de datos (no existe en Windows)
+        if not hasattr(os, "posix_fadvise"):
+            return
+        try:
+            with open(path, "rb") as f:
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        except OSError:
+            pass
 
     def get_photo_filepath(row) -> str:
         fp = (row["filepath"] or "").strip() if "filepath" in row.keys() else ""
@@ -231,13 +518,23 @@ def create_app():
             password = request.form.get("password", "")
 
             conn = get_db()
-            row = conn.execute("SELECT * FROM users WHERE username = ?", (username,)).fetchone()
-            conn.close()
+            row = conn.execute(
+                "SELECT id, username, password_hash, is_admin FROM users WHERE username = ?",
+                (username,)
+            ).fetchone()
 
-            if not row or not check_password_hash(row["password_hash"], password):
+            if not row or not verify_password(row["password_hash"], password):
                 flash("Usuario o contraseña incorrectos.", "error")
                 return redirect(url_for("login"))
 
+            # migra hashes antiguos (o con parámetros viejos) a argon2id
+            if password_needs_rehash(row["password_hash"]):
+                conn.execute(
+                    "UPDATE users SET password_hash = ? WHERE id = ?",
+                    (hash_password(password), int(row["id"])),
+                )
+                conn.commit()
+
             login_user(User(row))
             return redirect(url_for("dashboard"))
 
@@ -262,18 +559,19 @@ def create_app():
                 return redirect(url_for("change_password"))
 
             conn = get_db()
-            row = conn.execute("SELECT * FROM users WHERE id = ?", (int(current_user.id),)).fetchone()
-            if not row or not check_password_hash(row["password_hash"], current_pw):
-                conn.close()
+            row = conn.execute(
+                "SELECT password_hash FROM users WHERE id = ?",
+                (int(current_user.id),)
+            ).fetchone()
+            if not row or not verify_password(row["password_hash"], current_pw):
                 flash("Tu contraseña actual es incorrecta.", "error")
                 return redirect(url_for("change_password"))
 
             conn.execute(
                 "UPDATE users SET password_hash = ? WHERE id = ?",
-                (generate_password_hash(new_pw), int(current_user.id)),
+                (hash_password(new_pw), int(current_user.id)),
             )
             conn.commit()
-            conn.close()
 
             flash("Contraseña actualizada.", "success")
             return redirect(url_for("dashboard"))
@@ -289,7 +587,6 @@ def create_app():
         projects = conn.execute(
             "SELECT id, name, slug, created_at, description, status FROM projects ORDER BY id DESC"
         ).fetchall()
-        conn.close()
         return render_template("admin.html", users=users, projects=projects)
 
     @app.route("/admin/users/create", methods=["POST"])
@@ -307,14 +604,12 @@ def create_app():
         try:
             conn.execute(
                 "INSERT INTO users (username, password_hash, is_admin) VALUES (?, ?, ?)",
-                (username, generate_password_hash(password), is_admin),
+                (username, hash_password(password), is_admin),
             )
             conn.commit()
             flash("Usuario creado.", "success")
         except sqlite3.IntegrityError:
             flash("Ese usuario ya existe.", "error")
-        finally:
-            conn.close()
 
         return redirect(url_for("admin_panel"))
 
@@ -332,7 +627,6 @@ def create_app():
         ).fetchone()
 
         if not target:
-            conn.close()
             flash("Usuario no encontrado.", "error")
             return redirect(url_for("admin_panel"))
 
@@ -341,14 +635,12 @@ def create_app():
                 "SELECT COUNT(*) AS c FROM users WHERE is_admin = 1"
             ).fetchone()["c"]
             if admins_count <= 1:
-                conn.close()
                 flash("No puedes eliminar el último administrador.", "error")
                 return redirect(url_for("admin_panel"))
 
         conn.execute("UPDATE photos SET uploaded_by = NULL WHERE uploaded_by = ?", (user_id,))
         conn.execute("DELETE FROM users WHERE id = ?", (user_id,))
         conn.commit()
-        conn.close()
 
         flash(f"Usuario '{target['username']}' eliminado.", "success")
         return redirect(url_for("admin_panel"))
@@ -368,9 +660,15 @@ def create_app():
 
         conn = get_db()
         try:
+            # una sola consulta para todos los candidatos base, base_2, base_3...
             base = slug
+            rows = conn.execute(
+                "SELECT slug FROM projects WHERE slug = ? OR slug LIKE ? ESCAPE '\\'",
+                (base, base.replace("_", "\\_") + "\\_%"),
+            ).fetchall()
+            taken = {r["slug"] for r in rows}
             i = 2
-            while conn.execute("SELECT 1 FROM projects WHERE slug = ?", (slug,)).fetchone():
+            while slug in taken:
                 slug = f"{base}_{i}"
                 i += 1
 
@@ -385,8 +683,6 @@ def create_app():
             flash("Proyecto creado.", "success")
         except sqlite3.IntegrityError:
             flash("Ese proyecto ya existe.", "error")
-        finally:
-            conn.close()
 
         return redirect(url_for("admin_panel"))
 
@@ -394,9 +690,11 @@ def create_app():
     @admin_required
     def admin_edit_project(project_id):
         conn = get_db()
-        project = conn.execute("SELECT * FROM projects WHERE id = ?", (project_id,)).fetchone()
+        project = conn.execute(
+            "SELECT id, name, description, status FROM projects WHERE id = ?",
+            (project_id,)
+        ).fetchone()
         if not project:
-            conn.close()
             flash("Proyecto no encontrado.", "error")
             return redirect(url_for("admin_panel"))
 
@@ -406,7 +704,6 @@ def create_app():
             status = request.form.get("status", "pendiente").strip()
 
             if not name:
-                conn.close()
                 flash("El nombre es obligatorio.", "error")
                 return redirect(url_for("admin_edit_project", project_id=project_id))
 
@@ -419,12 +716,9 @@ def create_app():
                 flash("Proyecto actualizado.", "success")
             except sqlite3.IntegrityError:
                 flash("Ya existe un proyecto con ese nombre.", "error")
-            finally:
-                conn.close()
 
             return redirect(url_for("admin_panel"))
 
-        conn.close()
         return render_template("edit_project.html", project=project)
 
     @app.route("/admin/projects/<int:project_id>/delete", methods=["POST"])
@@ -434,18 +728,15 @@ def create_app():
 
         proj = conn.execute("SELECT id, slug FROM projects WHERE id = ?", (project_id,)).fetchone()
         if not proj:
-            conn.close()
             flash("Proyecto no encontrado.", "error")
             return redirect(url_for("admin_panel"))
 
         if proj["slug"] == "general":
-            conn.close()
             flash("No se puede eliminar el proyecto General.", "error")
             return redirect(url_for("admin_panel"))
 
         general = conn.execute("SELECT id, slug FROM projects WHERE slug = 'general'").fetchone()
         if not general:
-            conn.close()
             flash("No existe el proyecto General.", "error")
             return redirect(url_for("admin_panel"))
 
@@ -456,6 +747,7 @@ def create_app():
 
         (UPLOADS_ROOT / "general").mkdir(parents=True, exist_ok=True)
 
+        moved = []
         for ph in photos:
             old_fp = (ph["filepath"] or "").strip() if ph["filepath"] else ""
             if not old_fp and ph["filename"]:
@@ -476,14 +768,16 @@ def create_app():
             except Exception:
                 pass
 
-            conn.execute(
+            moved.append((general["id"], new_fp, os.path.basename(new_fp), int(ph["id"])))
+
+        # una sola transacción para todas las fotos + el borrado del proyecto
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(
                 "UPDATE photos SET project_id = ?, filepath = ?, filename = ? WHERE id = ?",
-                (general["id"], new_fp, os.path.basename(new_fp), int(ph["id"]))
+                moved,
             )
-
-        conn.execute("DELETE FROM projects WHERE id = ?", (project_id,))
-        conn.commit()
-        conn.close()
+            conn.execute("DELETE FROM projects WHERE id = ?", (project_id,))
 
         flash("Proyecto eliminado. Las fotos se movieron a General.", "success")
         return redirect(url_for("admin_panel"))
@@ -491,18 +785,45 @@ def create_app():
     @app.route("/admin/backup")
     @admin_required
     def download_backup():
-        mem = io.BytesIO()
-        with zipfile.ZipFile(mem, mode="w", compression=zipfile.ZIP_DEFLATED) as z:
-            if DB_PATH.exists():
-                z.write(DB_PATH, arcname="backup/app.db")
-            if UPLOADS_ROOT.exists():
-                for p in UPLOADS_ROOT.rglob("*"):
-                    if p.is_file():
-                        rel = p.relative_to(UPLOADS_ROOT).as_posix()
-                        z.write(p, arcname=f"backup/uploads/{rel}")
-
-        mem.seek(0)
-        return send_file(mem, as_attachment=True, download_name="backup_fotos.zip", mimetype="application/zip")
+        # con WAL app.db no tiene por qué incluir los últimos commits (pueden seguir
+        # en app.db-wal) y otros hilos escriben mientras se descarga: se copia una
+        # instantánea consistente con la API de backup de SQLite y se sirve esa
+        fd, snapshot_path = tempfile.mkstemp(prefix="backup_", suffix=".db")
+        os.close(fd)
+
+        def remove_snapshot():
+            Path(snapshot_path).unlink(missing_ok=True)
+
+        try:
+            snapshot = sqlite3.connect(snapshot_path)
+            try:
+                get_db().backup(snapshot)
+            finally:
+                snapshot.close()
+        except Exception:
+            remove_snapshot()
+            raise
+
+        entries = [(snapshot_path, "backup/app.db")]
+        if UPLOADS_ROOT.exists():
+            for p in iter_files(UPLOADS_ROOT):
+                rel = os.path.relpath(p, UPLOADS_ROOT).replace(os.sep, "/")
+                entries.append((p, f"backup/uploads/{rel}"))
+
+        def stream():
+            try:
+                yield from iter_zip(entries)
+            finally:
+                remove_snapshot()
+
+        response = Response(
+            stream(),
+            mimetype="application/zip",
+            headers={"Content-Disposition": "attachment; filename=backup_fotos.zip"},
+        )
+        # si el cuerpo nunca llega a iterarse (p. ej. HEAD) el finally no se ejecuta
+        response.call_on_close(remove_snapshot)
+        return response
 
     # ---- DASHBOARD (BÚSQUEDA) ----
     @app.route("/dashboard")
@@ -514,12 +835,16 @@ def create_app():
         date_to = request.args.get("date_to", "").strip()
 
         conn = get_db()
-        projects = conn.execute("SELECT id, name FROM projects ORDER BY name ASC").fetchall()
+        projects = get_projects_cached()
 
         where = []
         params = []
 
-        if q:
+        # trigram necesita al menos 3 caracteres; con menos se usa LIKE
+        if q and photos_fts_enabled and len(q) >= 3:
+            where.append("p.id IN (SELECT rowid FROM photos_fts WHERE photos_fts MATCH ?)")
+            params.append('"' + q.replace('"', '""') + '"')
+        elif q:
             where.append("(p.display_name LIKE ? OR p.description LIKE ?)")
             params.extend([f"%{q}%", f"%{q}%"])
 
@@ -538,15 +863,14 @@ def create_app():
         where_sql = ("WHERE " + " AND ".join(where)) if where else ""
 
         photos = conn.execute(f"""
-            SELECT p.*, pr.name AS project_name
+            SELECT p.id, p.filepath, p.display_name, p.description, p.uploaded_at, p.project_id,
+                   pr.name AS project_name
             FROM photos p
             LEFT JOIN projects pr ON pr.id = p.project_id
             {where_sql}
             ORDER BY p.id DESC
         """, params).fetchall()
 
-        conn.close()
-
         return render_template(
             "dashboard.html",
             photos=photos,
@@ -563,7 +887,7 @@ def create_app():
     @upload_required
     def upload():
         conn = get_db()
-        projects = conn.execute("SELECT id, name, slug FROM projects ORDER BY name ASC").fetchall()
+        projects = get_projects_cached()
 
         if request.method == "POST":
             file = request.files.get("photo")
@@ -572,23 +896,19 @@ def create_app():
             project_id = request.form.get("project_id", "").strip()
 
             if not project_id:
-                conn.close()
                 flash("Selecciona un proyecto.", "error")
                 return redirect(url_for("upload"))
 
             proj = conn.execute("SELECT id, slug FROM projects WHERE id = ?", (project_id,)).fetchone()
             if not proj:
-                conn.close()
                 flash("Proyecto inválido.", "error")
                 return redirect(url_for("upload"))
 
             if not file or file.filename == "":
-                conn.close()
                 flash("Selecciona una imagen.", "error")
                 return redirect(url_for("upload"))
 
             if not display_name:
-                conn.close()
                 flash("El nombre/código es obligatorio.", "error")
                 return redirect(url_for("upload"))
 
@@ -596,7 +916,6 @@ def create_app():
             ext = Path(original_name).suffix.lower().lstrip(".")
 
             if ext not in ALLOWED_EXTENSIONS:
-                conn.close()
                 flash("Formato no permitido. Usa JPG/PNG/WEBP.", "error")
                 return redirect(url_for("upload"))
 
@@ -612,6 +931,7 @@ def create_app():
 
             save_path = target_dir / final_name
             file.save(save_path)
+            drop_page_cache(save_path)
 
             filepath = f"{project_slug}/{final_name}"
 
@@ -621,12 +941,10 @@ def create_app():
             """, (filepath, final_name, display_name, description, int(current_user.id), int(project_id)))
 
             conn.commit()
-            conn.close()
 
             flash("Imagen subida correctamente.", "success")
             return redirect(url_for("dashboard"))
 
-        conn.close()
         return render_template("upload.html", projects=projects)
 
     # ---- EDIT PHOTO (renombra archivo si cambia display_name + mueve si cambia proyecto) ----
@@ -636,18 +954,18 @@ def create_app():
         conn = get_db()
 
         photo = conn.execute("""
-            SELECT p.*, pr.name AS project_name, pr.slug AS project_slug
+            SELECT p.id, p.filepath, p.filename, p.display_name, p.description, p.project_id,
+                   pr.name AS project_name, pr.slug AS project_slug
             FROM photos p
             LEFT JOIN projects pr ON pr.id = p.project_id
             WHERE p.id = ?
         """, (photo_id,)).fetchone()
 
         if not photo:
-            conn.close()
             flash("Foto no encontrada.", "error")
             return redirect(url_for("dashboard"))
 
-        projects = conn.execute("SELECT id, name, slug FROM projects ORDER BY name ASC").fetchall()
+        projects = get_projects_cached()
 
         if request.method == "POST":
             new_display_name = request.form.get("display_name", "").strip()
@@ -655,18 +973,15 @@ def create_app():
             new_project_id = request.form.get("project_id", "").strip()
 
             if not new_display_name:
-                conn.close()
                 flash("El nombre/código es obligatorio.", "error")
                 return redirect(url_for("edit_photo", photo_id=photo_id))
 
             if not new_project_id:
-                conn.close()
                 flash("Selecciona un proyecto.", "error")
                 return redirect(url_for("edit_photo", photo_id=photo_id))
 
             new_proj = conn.execute("SELECT id, slug FROM projects WHERE id = ?", (new_project_id,)).fetchone()
             if not new_proj:
-                conn.close()
                 flash("Proyecto inválido.", "error")
                 return redirect(url_for("edit_photo", photo_id=photo_id))
 
@@ -701,17 +1016,29 @@ def create_app():
             if project_changed or name_changed:
                 try:
                     if old_path and old_path.exists():
-                        if new_path.exists():
-                            new_filename = f"{base}_{int(time.time())}.{ext}"
-                            new_fp = f"{new_proj['slug']}/{new_filename}"
-                            new_path = UPLOADS_ROOT / new_fp
-                        old_path.replace(new_path)
+                        # reserva el destino de forma atómica (O_EXCL) en vez de exists() + replace()
+                        attempt = 0
+                        while True:
+                            try:
+                                fd = os.open(new_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+                                break
+                            except FileExistsError:
+                                attempt += 1
+                                new_filename = f"{base}_{int(time.time())}_{attempt}.{ext}"
+                                new_fp = f"{new_proj['slug']}/{new_filename}"
+                                new_path = UPLOADS_ROOT / new_fp
+                        os.close(fd)
+
+                        try:
+                            os.replace(old_path, new_path)
+                        except OSError:
+                            new_path.unlink(missing_ok=True)
+                            raise
                     else:
                         flash("Aviso: no se encontró el archivo físico para mover/renombrar.", "error")
                         new_fp = old_fp
                         new_filename = old_filename
                 except Exception as e:
-                    conn.close()
                     flash(f"No se pudo mover/renombrar el archivo: {e}", "error")
                     return redirect(url_for("edit_photo", photo_id=photo_id))
 
@@ -722,21 +1049,18 @@ def create_app():
             """, (new_display_name, new_description, int(new_project_id), new_fp, new_filename, photo_id))
 
             conn.commit()
-            conn.close()
 
             flash("Foto actualizada.", "success")
             return redirect(url_for("dashboard"))
 
-        conn.close()
         return render_template("edit_photo.html", photo=photo, projects=projects)
 
     @app.route("/photos/<int:photo_id>/delete", methods=["POST"])
     @admin_required
     def delete_photo(photo_id):
         conn = get_db()
-        photo = conn.execute("SELECT * FROM photos WHERE id = ?", (photo_id,)).fetchone()
+        photo = conn.execute("SELECT filepath, filename FROM photos WHERE id = ?", (photo_id,)).fetchone()
         if not photo:
-            conn.close()
             flash("Foto no encontrada.", "error")
             return redirect(url_for("dashboard"))
 
@@ -751,7 +1075,6 @@ def create_app():
 
         conn.execute("DELETE FROM photos WHERE id = ?", (photo_id,))
         conn.commit()
-        conn.close()
 
         flash("Foto eliminada.", "success")
         return redirect(url_for("dashboard"))
@@ -760,6 +1083,15 @@ def create_app():
     @app.route("/uploads/<path:filepath>")
     @login_required
     def uploaded_file(filepath):
+        if uploads_accel_prefix:
+            safe_path = safe_join(str(UPLOADS_ROOT), filepath)
+            if safe_path is None:
+                abort(404)
+            mimetype = mimetypes.guess_type(safe_path)[0] or "application/octet-stream"
+            return Response(
+                mimetype=mimetype,
+                headers={"X-Accel-Redirect": f"{uploads_accel_prefix}/{quote(filepath)}"},
+            )
         return send_from_directory(UPLOADS_ROOT, filepath)
 
     return app
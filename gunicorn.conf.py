@@ -0,0 +1,18 @@
+# Configuración de producción: gunicorn la carga sola desde el directorio actual
+#   gunicorn app:app
+# (equivale a: gunicorn -k gthread -w 2 --threads 16 app:app)
+#
+# /uploads/<path> es casi todo E/S, así que con hilos un mismo proceso atiende
+# muchas imágenes a la vez. Cada hilo usa su propia conexión SQLite (ver get_db)
+# y busy_timeout=5000 hace que los escritores esperen en vez de fallar con
+# "database is locked".
+import os
+
+bind = os.environ.get("GUNICORN_BIND", "127.0.0.1:8000")
+worker_class = "gthread"
+workers = int(os.environ.get("GUNICORN_WORKERS", "2"))
+threads = int(os.environ.get("GUNICORN_THREADS", "16"))
+
+# create_app() abre conexiones SQLite al importarse: que cada worker importe la
+# app después del fork en lugar de heredar las conexiones del proceso maestro
+preload_app = False
@@ -1,13 +1,18 @@
-from jinja2 import Environment, FileSystemLoader, TemplateSyntaxError
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader, TemplateSyntaxError
+import os
 import sys
+import tempfile
 
 TPL_DIR = r"c:\Users\Eduardo Santos\Desktop\foto_manager\templates"
 TPL_NAME = 'admin.html'
 
-env = Environment(loader=FileSystemLoader(TPL_DIR))
+# El bytecode compilado se reutiliza mientras la plantilla no cambie
+CACHE_DIR = os.path.join(tempfile.gettempdir(), 'jinja_cache')
+os.makedirs(CACHE_DIR, exist_ok=True)
+
+env = Environment(loader=FileSystemLoader(TPL_DIR), bytecode_cache=FileSystemBytecodeCache(CACHE_DIR))
 try:
-    src = env.loader.get_source(env, TPL_NAME)[0]
-    env.parse(src)
+    env.get_template(TPL_NAME)
     print('TEMPLATE_OK')
 except TemplateSyntaxError as e:
     print('TEMPLATE_ERROR')